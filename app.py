@@ -2,13 +2,15 @@
 import os
 os.environ["TOKENIZERS_PARALLELISM"] = "false"
 
+import uuid
 import streamlit as st
 from dotenv import load_dotenv
 
 # ---- your modules ----
-from llm import answer_with_tone
 from embed import EmbeddingStore
-from clean import clean_query
+from final_pipeline import run_turn
+from llm import DeadlineExceeded
+from querylog import QueryLogger
 from video import list_channel_videos
 from extract_sub import get_subtitle_whisper
 
@@ -18,9 +20,10 @@ st.set_page_config(page_title="RAG Chat + Ingest", page_icon="💬")
 
 @st.cache_resource(show_spinner=True)
 def get_store():
-    return EmbeddingStore()
+    return EmbeddingStore(n_shards=int(os.environ.get("EMBED_SHARDS", "1")))
 
 store = get_store()
+query_logger = QueryLogger.from_env()  # set QUERY_LOG_PATH to record chat turns
 
 # ------------- session state -------------
 if "view" not in st.session_state:
@@ -29,6 +32,8 @@ if "messages" not in st.session_state:
     st.session_state.messages = []
 if "yt_videos" not in st.session_state:
     st.session_state.yt_videos = []
+if "session_id" not in st.session_state:
+    st.session_state.session_id = str(uuid.uuid4())
 
 # ------------- shared header with view switch -------------
 def header(title_left: str):
@@ -51,6 +56,8 @@ tone = st.sidebar.text_input("Tone", value="concise, friendly")
 temperature = st.sidebar.slider("Temperature", 0.0, 1.5, 0.6, 0.1)
 max_tokens = st.sidebar.number_input("Max tokens", min_value=64, max_value=4096, value=1024, step=64)
 top_k = st.sidebar.slider("Top-K chunks", 1, 10, 3, 1)
+deadline_s = st.sidebar.number_input("Answer deadline (s)", min_value=5, max_value=120, value=30, step=5)
+hedge = st.sidebar.checkbox("Hedge slow LLM requests", value=False)
 show_chunks = st.sidebar.checkbox("Show retrieved chunks (in Chat view)", value=True)
 if st.sidebar.button("Clear chat history"):
     st.session_state.messages = []
@@ -84,16 +91,23 @@ def render_chat():
         st.session_state.messages.append({"role": "user", "content": user_query})
         with st.chat_message("assistant"):
             with st.spinner("Thinking..."):
-                filtered_query = clean_query(user_query)
-                chunks = store.query(filtered_query, top_k=int(top_k))
-                reply = answer_with_tone(
-                    query=user_query,
-                    chunks=[r.get("text", str(r)) for r in chunks],
-                    tone=tone,
-                    temperature=float(temperature),
-                    max_tokens=int(max_tokens),
-                    stream=False,
-                )
+                try:
+                    turn = run_turn(
+                        store,
+                        user_query,
+                        top_k=int(top_k),
+                        tone=tone,
+                        temperature=float(temperature),
+                        max_tokens=int(max_tokens),
+                        logger=query_logger,
+                        session=st.session_state.session_id,
+                        deadline_s=float(deadline_s),
+                        hedge=hedge,
+                    )
+                except DeadlineExceeded as e:
+                    st.error(f"The model did not answer in time — please retry. ({e})")
+                    return
+                reply, chunks = turn["reply"], turn["chunks"]
             st.markdown(reply)
         st.session_state.messages.append({"role": "assistant", "content": reply, "chunks": chunks})
         st.rerun()
@@ -140,15 +154,20 @@ def render_ingest():
                             model_name=model_name,
                             language=language,
                         )
-                        # If your EmbeddingStore supports metadata, attach it:
-                        # store.add_text(transcript, metadata={"source": "youtube", "title": title, "url": v["url"]})
-                        store.add_text(transcript)
-                        st.write(f"✅ Added: **{title}**")
+                        # re-ingesting a video replaces its chunks instead of piling up copies
+                        store.delete_source(v["url"])
+                        ids = store.add_text(transcript, source=v["url"])
+                        st.write(f"✅ Added: **{title}** ({len(set(ids))} unique of {len(ids)} chunks)")
                     except Exception as e:
                         st.write(f"⚠️ Skipped **{title}** — {e}")
                     prog.progress(i / len(videos))
                     if show_embeds:
                         st.video(v["url"])
+                stats = store.stats()
+                st.write(
+                    f"Index: **{stats['live']}** live chunks, {stats['dupes_skipped']} duplicate chunks skipped, "
+                    f"{stats['file_bytes'] / 1e6:.1f} MB on disk."
+                )
                 status.update(label="Done ingesting videos.", state="complete")
                 st.success("Embeddings updated with YouTube transcripts.")
             except Exception as e:
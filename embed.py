@@ -9,105 +9,474 @@ from typing import List, Dict, Any
 
 import re
 import os
+import time
+import hashlib
 import pickle
 import uuid
+import threading
 import numpy as np
 from sentence_transformers import SentenceTransformer
-from typing import List, Dict, Any
+from contextlib import contextmanager
+from typing import List, Dict, Any, Optional
+from shard import ShardedIndex, top_k_indices
+
+try:
+    import fcntl
+except ImportError:  # Windows: no cross-process write lock
+    fcntl = None
+
+
+DEFAULT_MODEL = "sentence-transformers/all-MiniLM-L6-v2"
+INDEX_FORMAT = 1
+NEAR_DUP_THRESHOLD = 0.97  # cosine at/above which a new chunk counts as a repeat
+COMPACT_RATIO = 0.3        # auto-compact once this share of rows is tombstoned
+SHARD_TAIL_RATIO = 0.25    # rewrite the shard base once appended rows reach this share of it
+
+
+def text_hash(text: str) -> str:
+    """Hash of the text with case, punctuation and whitespace normalised away."""
+    norm = re.sub(r"\W+", " ", text.lower()).strip()
+    return hashlib.sha1(norm.encode("utf-8")).hexdigest()
+
+
+def read_index(path: str) -> Dict[str, Any]:
+    """Load a pickled index. Pre-manifest pickles come back with manifest=None."""
+    with open(path, "rb") as f:
+        data = pickle.load(f)
+    data.setdefault("manifest", None)
+    return data
+
+
+def stage_index(path: str, data: Dict[str, Any]) -> str:
+    """Pickle `data` next to `path` and return the temp file; os.replace() it to publish."""
+    tmp = f"{path}.tmp-{os.getpid()}"
+    with open(tmp, "wb") as f:
+        pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+    return tmp
+
+
+def write_index(path: str, data: Dict[str, Any]) -> None:
+    """Write an index atomically: readers see either the old file or the new one."""
+    os.replace(stage_index(path, data), path)
+
+
+@contextmanager
+def index_lock(path: str):
+    """
+    Exclusive lock on `<path>.lock` for check-then-replace of the index file.
+    Every writer (EmbeddingStore saves, reindex.py cut-over and rollback) takes
+    it, across threads and processes.
+    """
+    if fcntl is None:
+        yield
+        return
+    with open(path + ".lock", "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def make_manifest(model_name: str, dim: int, version: int = 1) -> Dict[str, Any]:
+    return {
+        "format": INDEX_FORMAT,
+        "version": version,
+        "model_name": model_name,
+        "dim": int(dim),
+        "normalize": True,
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+    }
 
 
 class EmbeddingStore:
-    def __init__(self, cache_path: str = "vector_cache.pkl", model_name: str = "sentence-transformers/all-MiniLM-L6-v2"):
+    def __init__(self, cache_path: str = "vector_cache.pkl", model_name: Optional[str] = None, n_shards: int = 1):
+        """
+        `model_name=None` uses whatever encoder the cached index was built with
+        (DEFAULT_MODEL for a fresh index). Passing a different model than the
+        index manifest records raises instead of mixing vector spaces; use
+        reindex.py to re-embed the stored texts with the new model.
+        """
         self.cache_path = cache_path
-        self.model = SentenceTransformer(model_name)
+        self._lock = threading.RLock()
+
+        # n_shards > 1 searches through long-lived worker processes (see shard.py)
+        self.n_shards = n_shards
+        self._sharded = None
+        self._shards_stale = True   # rows renumbered (load, compaction): full rebuild
+        self._shard_rows = 0        # rows already sent to the shards; later ones get appended
+        self._shard_kills: List[int] = []  # tombstones not yet sent to the shards
+        self.dupes_skipped = 0
+        self._state_gen = 0      # bumped whenever rows are (re)loaded from the file
+        self._write_depth = 0    # nesting of _writing() on the thread holding the lock
 
         # Try to load cache if exists
-        if os.path.exists(cache_path):
-            with open(cache_path, "rb") as f:
-                data = pickle.load(f)
-            self._ids = data["ids"]
-            self._texts = data["texts"]
-            self._embeddings = data["embeddings"]
+        data = read_index(cache_path) if os.path.exists(cache_path) else None
+        manifest = data["manifest"] if data else None
+        self.model_name = self._resolve_model(manifest, model_name)
+        self.model = SentenceTransformer(self.model_name)
+        dim = self.model.get_sentence_embedding_dimension()
+
+        if data:
+            self._set_state(data)
+            if manifest is None:
+                # legacy pickle: best we can do is check the dimension
+                if self._embeddings.size and self._embeddings.shape[1] != dim:
+                    raise ValueError(
+                        f"{cache_path} has {self._embeddings.shape[1]}-d vectors but {self.model_name} "
+                        f"produces {dim}-d; re-embed it with reindex.py"
+                    )
+                manifest = make_manifest(self.model_name, dim, version=0)
+            self.manifest = manifest
+            self._mtime = os.stat(cache_path).st_mtime_ns
         else:
-            self._ids: List[str] = []
-            self._texts: List[str] = []
-            self._embeddings = np.empty((0, self.model.get_sentence_embedding_dimension()), dtype=np.float32)
+            self._set_state({"ids": [], "texts": [], "embeddings": np.empty((0, dim), dtype=np.float32)})
+            self.manifest = make_manifest(self.model_name, dim)
+            self._mtime = None
+
+    @staticmethod
+    def _resolve_model(manifest: Optional[Dict[str, Any]], model_name: Optional[str]) -> str:
+        if manifest is None:
+            return model_name or DEFAULT_MODEL
+        if model_name and model_name != manifest["model_name"]:
+            raise ValueError(
+                f"index was built with {manifest['model_name']!r}, not {model_name!r}; "
+                f"run `python reindex.py --model {model_name}` to re-embed it"
+            )
+        return manifest["model_name"]
 
-    def _embed(self, texts: List[str]) -> np.ndarray:
-        return self.model.encode(texts, normalize_embeddings=True, convert_to_numpy=True).astype(np.float32)
+    def _embed(self, texts: List[str], model: Optional[SentenceTransformer] = None) -> np.ndarray:
+        return (model or self.model).encode(texts, normalize_embeddings=True, convert_to_numpy=True).astype(np.float32)
+
+    def _set_state(self, data: Dict[str, Any]) -> None:
+        """Adopt the rows of a loaded index and rebuild the derived lookups."""
+        n = len(data["ids"])
+        deleted = set(data.get("deleted", ()))
+        self._ids: List[str] = data["ids"]
+        self._texts: List[str] = data["texts"]
+        # every source that added a row; older files store a single source per row
+        self._sources: List[List[Optional[str]]] = [
+            list(src) if isinstance(src, list) else [src] for src in (data.get("sources") or [None] * n)
+        ]
+        self._embeddings = data["embeddings"]
+        self._alive = np.fromiter((cid not in deleted for cid in self._ids), dtype=bool, count=n)
+        self._rows: Dict[str, int] = {cid: i for i, cid in enumerate(self._ids)}
+        self._hashes: Dict[str, str] = {
+            text_hash(t): cid for cid, t, ok in zip(self._ids, self._texts, self._alive) if ok
+        }
+        self._shards_stale = True
+        self._state_gen += 1
+
+    def _payload(self) -> Dict[str, Any]:
+        return {
+            "manifest": self.manifest,
+            "ids": self._ids,
+            "texts": self._texts,
+            "sources": self._sources,
+            "embeddings": self._embeddings,
+            "deleted": [cid for cid, ok in zip(self._ids, self._alive) if not ok],
+        }
 
     def _save_cache(self):
-        with open(self.cache_path, "wb") as f:
-            pickle.dump(
-                {"ids": self._ids, "texts": self._texts, "embeddings": self._embeddings},
-                f,
-                protocol=pickle.HIGHEST_PROTOCOL
-            )
+        """Persist the rows; the caller is inside _writing()."""
+        write_index(self.cache_path, self._payload())
+        self._mtime = os.stat(self.cache_path).st_mtime_ns
+
+    @contextmanager
+    def _writing(self):
+        """
+        Hold the store lock and the file's index_lock() for a mutation, with the
+        in-memory rows first brought up to date with the file. A save can then
+        never overwrite a version another process wrote meanwhile (e.g. a
+        reindex.py cut-over during a slow encode).
+        """
+        with self._lock:
+            if self._write_depth:  # nested (e.g. _tombstone -> compact)
+                yield
+                return
+            with index_lock(self.cache_path):
+                self._write_depth += 1
+                try:
+                    self.refresh_if_changed()
+                    yield
+                finally:
+                    self._write_depth -= 1
+
+    def reload(self) -> None:
+        """
+        Re-read the cache file, e.g. after reindex.py cut over to a new version.
+        Swaps the encoder too if the new manifest names a different model.
+        """
+        data = read_index(self.cache_path)
+        manifest = data["manifest"] or make_manifest(self.model_name, data["embeddings"].shape[1], version=0)
+        model = self.model
+        if manifest["model_name"] != self.model_name:
+            model = SentenceTransformer(manifest["model_name"])
+        with self._lock:
+            self.model, self.model_name, self.manifest = model, manifest["model_name"], manifest
+            self._set_state(data)
+            self._mtime = os.stat(self.cache_path).st_mtime_ns
+
+    def refresh_if_changed(self) -> bool:
+        """Reload when another process replaced the cache file. Cheap enough to call per request."""
+        try:
+            mtime = os.stat(self.cache_path).st_mtime_ns
+        except FileNotFoundError:
+            return False
+        if mtime == self._mtime:
+            return False
+        self.reload()
+        return True
 
     def _chunk_text(self, text: str, words_per_chunk: int = 250) -> List[str]:
         """Split text into ~250-word chunks."""
         words = re.findall(r"\S+", text.strip())
         return [" ".join(words[i:i + words_per_chunk]) for i in range(0, len(words), words_per_chunk)]
-    def add_text(self, text: str) -> List[str]:
+    def add_text(
+        self,
+        text: str,
+        source: Optional[str] = None,
+        *,
+        dedupe: bool = True,
+        near_dup_threshold: Optional[float] = NEAR_DUP_THRESHOLD,
+    ) -> List[str]:
         """
         Break paragraph into 250-word chunks, embed, and store.
         Returns list of IDs (one per chunk).
+
+        With `dedupe`, a chunk whose normalised text is already indexed, or whose
+        vector has cosine >= `near_dup_threshold` with a live chunk (sponsor reads,
+        intros, outros), is not stored again; its slot in the result holds the id
+        of the chunk it duplicates, and `source` is added to that chunk's sources.
+        `source` (e.g. the video URL) enables delete_source().
         """
         chunks = self._chunk_text(text, words_per_chunk=250)
         if not chunks:
             return []
+        self.refresh_if_changed()
+        hashes = [text_hash(c) for c in chunks]
 
-        # embed all chunks in one call
-        embeddings = self._embed(chunks)
+        def _fresh() -> List[int]:
+            # exact repeats (already indexed, or earlier in this text) never reach the encoder
+            out, seen = [], set()
+            for j, h in enumerate(hashes):
+                if dedupe and (h in self._hashes or h in seen):
+                    continue
+                seen.add(h)
+                out.append(j)
+            return out
 
-        # append to memory
-        if self._embeddings.size == 0:
-            self._embeddings = embeddings
-        else:
-            self._embeddings = np.vstack([self._embeddings, embeddings])
+        # embed all chunks in one call, outside the lock
+        model, gen = self.model, self._state_gen
+        fresh = _fresh()
+        embeddings = self._embed([chunks[j] for j in fresh], model) if fresh else None
+
+        with self._writing():
+            if self._state_gen != gen:
+                # the file was replaced while we encoded (possibly by a new model): redo against it
+                fresh = _fresh()
+                embeddings = self._embed([chunks[j] for j in fresh]) if fresh else None
+
+            near = None
+            if fresh and dedupe and near_dup_threshold is not None:
+                near = self._nearest_live(embeddings)
+                batch_sims = embeddings @ embeddings.T  # fresh x fresh, for repeats within this text
+
+            by_hash: Dict[str, str] = {}
+            slot: Dict[int, str] = {}
+            keep_rows: List[int] = []
+            keep_ids: List[str] = []
+            for row, j in enumerate(fresh):
+                if near is not None:
+                    best_id, best = near[row]
+                    if keep_rows:
+                        in_batch = batch_sims[keep_rows, row]
+                        k = int(np.argmax(in_batch))
+                        if in_batch[k] > best:
+                            best_id, best = keep_ids[k], float(in_batch[k])
+                    if best >= near_dup_threshold:
+                        by_hash[hashes[j]] = slot[j] = best_id
+                        continue
+                cid = str(uuid.uuid4())
+                by_hash[hashes[j]] = slot[j] = cid
+                keep_rows.append(row)
+                keep_ids.append(cid)
+                self._rows[cid] = len(self._ids)
+                self._ids.append(cid)
+                self._texts.append(chunks[j])
+                self._sources.append([source])
+                self._hashes[hashes[j]] = cid
 
-        assigned_ids = []
-        for chunk in chunks:
-            cid = str(uuid.uuid4())
-            self._ids.append(cid)
-            self._texts.append(chunk)
-            assigned_ids.append(cid)
+            # every chunk maps to the id that now holds its content
+            assigned_ids = [slot.get(j) or by_hash.get(h) or self._hashes.get(h) for j, h in enumerate(hashes)]
+            self.dupes_skipped += len(chunks) - len(keep_rows)
 
-        # save automatically
-        self._save_cache()
+            # a skipped duplicate still belongs to `source`: record it on the surviving row
+            # so deleting the first source does not take the shared chunk with it
+            sources_changed = False
+            for cid in set(assigned_ids) - set(keep_ids) - {None}:
+                srcs = self._sources[self._rows[cid]]
+                if source not in srcs:
+                    srcs.append(source)
+                    sources_changed = True
+
+            if keep_rows:
+                # append to memory
+                if self._embeddings.size == 0:
+                    self._embeddings = embeddings[keep_rows]
+                else:
+                    self._embeddings = np.vstack([self._embeddings, embeddings[keep_rows]])
+                self._alive = np.concatenate([self._alive, np.ones(len(keep_rows), dtype=bool)])
+
+            if keep_rows or sources_changed:
+                # save automatically
+                self._save_cache()
 
         return assigned_ids
 
+    def _nearest_live(self, vecs: np.ndarray, block: int = 32) -> List[tuple]:
+        """(id, cosine) of the closest live indexed chunk for each row of `vecs`."""
+        if not self._alive.any():
+            return [(None, -np.inf)] * len(vecs)
+        out = []
+        # a few columns at a time keeps the N x block score matrix small on big indexes
+        for start in range(0, len(vecs), block):
+            sims = self._embeddings @ vecs[start:start + block].T
+            sims[~self._alive] = -np.inf
+            best = np.argmax(sims, axis=0)
+            out.extend((self._ids[i], float(sims[i, c])) for c, i in enumerate(best))
+        return out
+
     def query(self, query_text: str, top_k: int = 5) -> List[Dict[str, Any]]:
-        if len(self._ids) == 0:
+        self.refresh_if_changed()
+        if not self._alive.any():
             return []
-        q = self._embed([query_text])[0]
-        scores = (self._embeddings @ q).astype(float)
-        top_idx = np.argsort(-scores)[:top_k]
+        model = self.model
+        q = self._embed([query_text], model)[0]
+        # hold the lock only for a consistent snapshot; scoring runs unlocked so
+        # concurrent sessions search in parallel
+        with self._lock:
+            if model is not self.model:  # encoder swapped by reload() meanwhile
+                q = self._embed([query_text])[0]
+            ids, texts, emb, alive = self._ids, self._texts, self._embeddings, self._alive.copy()
+            gen = self._sync_shards() if self.n_shards > 1 else None
+
+        top_idx = None
+        if gen is not None:
+            top_idx, top_scores, got = self._sharded.search_gen(q, top_k)
+            if got != gen:  # a newer write rebuilt the shards after our snapshot
+                top_idx = None
+        if top_idx is None:
+            scores = emb @ q
+            scores[~alive] = -np.inf
+            top_idx = top_k_indices(scores, min(top_k, int(alive.sum())))
+            top_scores = scores[top_idx]
         return [
-            {"id": self._ids[i], "text": self._texts[i], "score": float(scores[i])}
-            for i in top_idx
+            {"id": ids[i], "text": texts[i], "score": float(s)}
+            for i, s in zip(top_idx, top_scores)
         ]
 
+    def _sync_shards(self) -> int:
+        """
+        Bring the shard workers up to date with the rows; caller holds the lock.
+        New rows are appended and deletes sent as tombstones, so this costs
+        O(changes); the base is only rewritten after a renumbering or once the
+        appended tail outgrows SHARD_TAIL_RATIO of it. Returns the generation.
+        """
+        if self._sharded is None:
+            self._sharded = ShardedIndex(self.n_shards, self.cache_path + ".shards")
+        n = len(self._ids)
+        sh = self._sharded
+        if self._shards_stale or sh.tail_rows + n - self._shard_rows > SHARD_TAIL_RATIO * sh.base_rows:
+            sh.build(self._ids, self._embeddings, rows=np.flatnonzero(self._alive))
+            self._shards_stale = False
+        else:
+            if n > self._shard_rows:
+                new = np.arange(self._shard_rows, n)
+                sh.append(self._ids, self._embeddings, new[self._alive[new]])
+            if self._shard_kills:
+                sh.kill(np.asarray(self._shard_kills))
+        self._shard_rows = n
+        self._shard_kills = []
+        return sh.generation
+
+    # ---------- deletes / compaction ----------
+    def delete(self, ids: List[str]) -> int:
+        """Tombstone chunks by id. Returns how many live chunks were removed."""
+        with self._writing():
+            rows = [self._rows[cid] for cid in set(ids) if cid in self._rows]
+            return self._tombstone(rows)
+
+    def delete_source(self, source: str) -> int:
+        """
+        Drop `source` (e.g. a video URL) from every chunk it added, and tombstone
+        the chunks no other source still references. Returns how many were tombstoned.
+        """
+        with self._writing():
+            rows, touched = [], False
+            for i, srcs in enumerate(self._sources):
+                if source in srcs:
+                    srcs.remove(source)
+                    touched = True
+                    if not srcs:
+                        rows.append(i)
+            removed = self._tombstone(rows)
+            if touched and not removed:
+                self._save_cache()  # only shared chunks: persist the dropped reference
+        return removed
+
+    def _tombstone(self, rows: List[int]) -> int:
+        """Mark `rows` dead and persist; the caller is inside _writing()."""
+        rows = [i for i in rows if self._alive[i]]
+        if not rows:
+            return 0
+        self._alive[rows] = False
+        for i in rows:
+            h = text_hash(self._texts[i])
+            if self._hashes.get(h) == self._ids[i]:
+                del self._hashes[h]
+        self._shard_kills.extend(rows)
+        if (~self._alive).sum() >= COMPACT_RATIO * len(self._ids):
+            self.compact()
+        else:
+            self._save_cache()
+        return len(rows)
+
+    def compact(self) -> int:
+        """Physically drop tombstoned rows from memory and from the cache file. Returns rows reclaimed."""
+        with self._writing():
+            keep = np.flatnonzero(self._alive)
+            dropped = len(self._ids) - len(keep)
+            self._ids = [self._ids[i] for i in keep]
+            self._texts = [self._texts[i] for i in keep]
+            self._sources = [self._sources[i] for i in keep]
+            self._embeddings = np.ascontiguousarray(self._embeddings[keep])
+            self._alive = np.ones(len(keep), dtype=bool)
+            self._rows = {cid: i for i, cid in enumerate(self._ids)}
+            self._shards_stale = True
+            self._save_cache()
+        return dropped
+
+    def stats(self) -> Dict[str, Any]:
+        """Row counts and sizes, e.g. to report what dedupe/compaction saved."""
+        live = int(self._alive.sum())
+        return {
+            "rows": len(self._ids),
+            "live": live,
+            "tombstoned": len(self._ids) - live,
+            "dupes_skipped": self.dupes_skipped,
+            "matrix_bytes": int(self._embeddings.nbytes),
+            "file_bytes": os.path.getsize(self.cache_path) if os.path.exists(self.cache_path) else 0,
+        }
+
 
     # ---------- persistence ----------
     def save(self, path: str) -> None:
-        with open(path, "wb") as f:
-            pickle.dump(
-                {"ids": self._ids, "texts": self._texts, "embeddings": self._embeddings},
-                f,
-                protocol=pickle.HIGHEST_PROTOCOL
-            )
+        write_index(path, self._payload())
 
     @staticmethod
-    def load(path: str, model_name: str = "sentence-transformers/all-MiniLM-L6-v2") -> "EmbeddingStore":
-        with open(path, "rb") as f:
-            data = pickle.load(f)
-        store = EmbeddingStore(model_name=model_name)
-        store._ids = data["ids"]
-        store._texts = data["texts"]
-        store._embeddings = data["embeddings"]
-        return store
+    def load(path: str, model_name: Optional[str] = None, n_shards: int = 1) -> "EmbeddingStore":
+        return EmbeddingStore(cache_path=path, model_name=model_name, n_shards=n_shards)
 
 
 # ----------- demo -----------
@@ -0,0 +1,160 @@
+import json
+import time
+import random
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional
+
+
+class FakeLLMServer:
+    """
+    Local stand-in for the Mistral chat completions endpoint, for load tests.
+
+    Answers POST /v1/chat/completions with a canned reply after a simulated
+    latency of `base_ms` + ms-per-output-token, with lognormal jitter. Point
+    llm.answer_with_tone at it with server_url=server.url (any api_key works).
+
+    Faults are injected per request: `rate_limit_rate` answers 429,
+    `error_rate` answers 503, and `slow_rate` adds `slow_ms` to the latency
+    (a heavy tail for exercising deadlines and hedging).
+    """
+
+    def __init__(
+        self,
+        host: str = "127.0.0.1",
+        port: int = 0,
+        *,
+        base_ms: float = 300.0,
+        ms_per_token: float = 8.0,
+        jitter: float = 0.3,
+        rate_limit_rate: float = 0.0,
+        error_rate: float = 0.0,
+        slow_rate: float = 0.0,
+        slow_ms: float = 5000.0,
+        seed: Optional[int] = None,
+    ):
+        self.base_ms = base_ms
+        self.ms_per_token = ms_per_token
+        self.jitter = jitter
+        self.rate_limit_rate = rate_limit_rate
+        self.error_rate = error_rate
+        self.slow_rate = slow_rate
+        self.slow_ms = slow_ms
+        self.requests = 0
+        self.faults = {"429": 0, "503": 0, "slow": 0}
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._httpd = ThreadingHTTPServer((host, port), self._handler())
+        self._httpd.daemon_threads = True
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def _latency_s(self, completion_tokens: int) -> float:
+        with self._lock:
+            noise = self._rng.lognormvariate(0.0, self.jitter) if self.jitter else 1.0
+            slow = self._rng.random() < self.slow_rate
+            if slow:
+                self.faults["slow"] += 1
+        ms = (self.base_ms + self.ms_per_token * completion_tokens) * noise
+        return (ms + (self.slow_ms if slow else 0.0)) / 1e3
+
+    def _fault(self) -> Optional[int]:
+        """Status code to fail this request with, if any."""
+        with self._lock:
+            r = self._rng.random()
+            if r < self.rate_limit_rate:
+                self.faults["429"] += 1
+                return 429
+            if r < self.rate_limit_rate + self.error_rate:
+                self.faults["503"] += 1
+                return 503
+        return None
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):  # keep load-test output readable
+                pass
+
+            def _reply(self, code: int, body: dict) -> None:
+                data = json.dumps(body).encode("utf-8")
+                try:
+                    self.send_response(code)
+                    self.send_header("Content-Type", "application/json")
+                    self.send_header("Content-Length", str(len(data)))
+                    self.end_headers()
+                    self.wfile.write(data)
+                except (BrokenPipeError, ConnectionResetError):
+                    pass  # client gave up (deadline hit or lost a hedge race)
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                req = json.loads(self.rfile.read(length) or b"{}")
+                if not self.path.rstrip("/").endswith("/chat/completions"):
+                    self._reply(404, {"message": f"unknown path {self.path}"})
+                    return
+                with server._lock:
+                    server.requests += 1
+                code = server._fault()
+                if code is not None:
+                    time.sleep(server.base_ms / 4e3)  # errors come back faster than answers
+                    self._reply(code, {"object": "error", "message": "injected fault", "code": str(code)})
+                    return
+
+                prompt = " ".join(str(m.get("content", "")) for m in req.get("messages", []))
+                prompt_tokens = max(1, len(prompt) // 4)  # ~4 chars per token
+                completion_tokens = min(int(req.get("max_tokens") or 256), 120)
+                time.sleep(server._latency_s(completion_tokens))
+                self._reply(200, {
+                    "id": f"fake-{server.requests}",
+                    "object": "chat.completion",
+                    "model": req.get("model", "fake"),
+                    "created": int(time.time()),
+                    "choices": [{
+                        "index": 0,
+                        "message": {"role": "assistant", "content": "lorem " * completion_tokens},
+                        "finish_reason": "stop",
+                    }],
+                    "usage": {
+                        "prompt_tokens": prompt_tokens,
+                        "completion_tokens": completion_tokens,
+                        "total_tokens": prompt_tokens + completion_tokens,
+                    },
+                })
+
+        return Handler
+
+    def start(self) -> "FakeLLMServer":
+        self._thread = threading.Thread(target=self._httpd.serve_forever, name="fake-llm", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Serve a fake Mistral chat completions API locally.")
+    ap.add_argument("--port", type=int, default=8765)
+    ap.add_argument("--base-ms", type=float, default=300.0)
+    ap.add_argument("--ms-per-token", type=float, default=8.0)
+    ap.add_argument("--jitter", type=float, default=0.3)
+    ap.add_argument("--rate-limit-rate", type=float, default=0.0, help="share of requests answered 429")
+    ap.add_argument("--error-rate", type=float, default=0.0, help="share of requests answered 503")
+    ap.add_argument("--slow-rate", type=float, default=0.0, help="share of requests delayed by --slow-ms")
+    ap.add_argument("--slow-ms", type=float, default=5000.0)
+    args = ap.parse_args()
+    srv = FakeLLMServer(
+        port=args.port, base_ms=args.base_ms, ms_per_token=args.ms_per_token, jitter=args.jitter,
+        rate_limit_rate=args.rate_limit_rate, error_rate=args.error_rate,
+        slow_rate=args.slow_rate, slow_ms=args.slow_ms,
+    )
+    print(f"Fake LLM on {srv.url}  (set MISTRAL_SERVER_URL={srv.url})")
+    srv._httpd.serve_forever()
@@ -1,32 +1,84 @@
 import os
 os.environ["TOKENIZERS_PARALLELISM"] = "false"
-from llm import answer_with_tone
+from llm import answer_with_tone, DEFAULT_DEADLINE_S
 
 from dotenv import load_dotenv
 load_dotenv()  # this loads .env variables into os.environ
 from embed import EmbeddingStore
 import re
+from typing import Any, Dict, Optional
 from clean import clean_query
+from querylog import QueryLogger, StageTimer
+
+
+def run_turn(
+    store: EmbeddingStore,
+    query: str,
+    *,
+    top_k: int = 3,
+    tone: str = "concise, friendly",
+    temperature: float = 0.6,
+    max_tokens: int = 1024,
+    logger: Optional[QueryLogger] = None,
+    session: Optional[str] = None,
+    **llm_kwargs: Any,
+) -> Dict[str, Any]:
+    """
+    One chat turn: clean -> retrieve -> answer.
+    Returns {"reply", "chunks", "timings_ms", "usage"}; also logged when `logger` is set,
+    including turns that raise (with an "error" field), so replays keep the failures.
+    """
+    timer = StageTimer()
+    usage: Dict[str, int] = {}
+    filtered_query, chunks, error = None, [], None
+    try:
+        with timer.stage("clean"):
+            filtered_query = clean_query(query)
+        with timer.stage("retrieve"):
+            chunks = store.query(filtered_query, top_k=top_k)
+        with timer.stage("answer"):
+            reply = answer_with_tone(
+                query=query,
+                chunks=[r.get("text", str(r)) for r in chunks],
+                tone=tone,
+                temperature=temperature,
+                max_tokens=max_tokens,
+                stream=False,
+                usage=usage,
+                **llm_kwargs,
+            )
+    except BaseException as e:
+        error = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        if logger is not None:
+            logger.log_turn(
+                raw_query=query,
+                cleaned_query=filtered_query,
+                top_k=top_k,
+                hits=chunks,
+                timer=timer,
+                usage=usage,
+                session=session,
+                tone=tone,
+                temperature=temperature,
+                max_tokens=max_tokens,
+                deadline_s=llm_kwargs.get("deadline_s", DEFAULT_DEADLINE_S),
+                hedge=bool(llm_kwargs.get("hedge", False)),
+                error=error,
+            )
+    return {"reply": reply, "chunks": chunks, "timings_ms": {**timer.ms, "total": timer.total()}, "usage": usage}
 
 
 if __name__ == "__main__":
     store = EmbeddingStore()
+    logger = QueryLogger.from_env()
 
 
     # query
     query = input("Enter your query: ")
     while query != "exit":
-        filtered_query = clean_query(query)
-        chunks = store.query(filtered_query, top_k=3)
-        print(chunks)
-        reply = answer_with_tone(
-            query=query,
-            chunks=[r["text"] for r in chunks],
-            tone="concise, friendly",
-            temperature=0.6,
-            max_tokens=1024,
-            stream=False,
-        )
-        print(reply)
+        turn = run_turn(store, query, top_k=3, tone="concise, friendly", temperature=0.6, max_tokens=1024, logger=logger)
+        print(turn["chunks"])
+        print(turn["reply"])
         query = input("Enter your query: ")
-
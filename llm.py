@@ -1,9 +1,155 @@
 # pip install mistralai
 import os
-from typing import Iterable, List, Optional, Generator, Union
+import time
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from typing import Any, Dict, Iterable, List, Optional, Generator, Union
+
+import httpx
 from mistralai import Mistral
+from tenacity import Retrying, retry_if_exception, stop_after_attempt, wait_random_exponential
 
 DEFAULT_MODEL = "mistral-small-latest"
+FALLBACK_MODEL = "ministral-8b-latest"   # smaller/faster model used when the deadline is close
+DEFAULT_DEADLINE_S = 30.0
+FALLBACK_AT = 0.7                        # share of the deadline the primary model may use before falling back
+RETRYABLE_STATUS = {408, 425, 429, 500, 502, 503, 504}
+MAX_CONCURRENCY = int(os.environ.get("MISTRAL_MAX_CONCURRENCY", "8"))
+HEDGE_MIN_SAMPLES = 20                   # below this, hedge after DEFAULT_HEDGE_DELAY_S
+DEFAULT_HEDGE_DELAY_S = 2.0
+
+
+class DeadlineExceeded(TimeoutError):
+    """No answer from the API before the per-request deadline."""
+
+
+# ---------- client-side limits and metrics (shared by every call in the process) ----------
+_limiter = threading.BoundedSemaphore(MAX_CONCURRENCY)
+# runs hedged requests; a request is submitted only once it owns a limiter slot, so
+# there are never more tasks than workers and none waits in the queue
+_pool = ThreadPoolExecutor(max_workers=MAX_CONCURRENCY, thread_name_prefix="mistral")
+_metrics_lock = threading.Lock()
+_latencies: deque = deque(maxlen=500)    # seconds, successful attempts only
+_METRIC_KEYS = ("calls", "attempts", "retries", "hedges", "hedge_wins", "hedges_skipped",
+                "fallbacks", "deadline_exceeded", "failures")
+_metrics: Dict[str, int] = dict.fromkeys(_METRIC_KEYS, 0)
+
+
+def _bump(key: str, n: int = 1) -> None:
+    with _metrics_lock:
+        _metrics[key] += n
+
+
+def _latency_pct(p: float) -> Optional[float]:
+    with _metrics_lock:
+        lat = sorted(_latencies)
+    if not lat:
+        return None
+    return lat[min(len(lat) - 1, int(p / 100 * len(lat)))]
+
+
+def _hedge_delay() -> float:
+    """Fire the hedge once the primary is slower than the recent p95."""
+    with _metrics_lock:
+        enough = len(_latencies) >= HEDGE_MIN_SAMPLES
+    return _latency_pct(95) if enough else DEFAULT_HEDGE_DELAY_S
+
+
+def get_metrics() -> Dict[str, Any]:
+    """Counters for retries / hedges / fallbacks plus recent API latency (ms)."""
+    with _metrics_lock:
+        out: Dict[str, Any] = dict(_metrics)
+    for p in (50, 95, 99):
+        v = _latency_pct(p)
+        out[f"latency_p{p}_ms"] = round(v * 1e3, 1) if v is not None else None
+    out["hedge_delay_ms"] = round(_hedge_delay() * 1e3, 1)
+    return out
+
+
+def reset_metrics() -> None:
+    with _metrics_lock:
+        _metrics.update(dict.fromkeys(_METRIC_KEYS, 0))
+        _latencies.clear()
+
+
+def _is_retryable(exc: BaseException) -> bool:
+    if isinstance(exc, DeadlineExceeded):
+        return False
+    if isinstance(exc, (httpx.TimeoutException, httpx.TransportError)):
+        return True
+    return getattr(exc, "status_code", None) in RETRYABLE_STATUS
+
+
+def _complete_with_slot(client: Mistral, kwargs: Dict[str, Any], deadline: float, cutoff: float) -> Any:
+    """
+    One HTTP attempt that gives up at `cutoff` (<= deadline); the caller already
+    holds a limiter slot, released here.
+    """
+    try:
+        now = time.monotonic()
+        if deadline - now <= 0:
+            raise DeadlineExceeded("deadline passed before the request was sent")
+        timeout = (cutoff if cutoff > now else deadline) - now
+        _bump("attempts")
+        resp = client.chat.complete(**kwargs, timeout_ms=max(1, int(timeout * 1e3)))
+        with _metrics_lock:
+            _latencies.append(time.monotonic() - now)
+        return resp
+    finally:
+        _limiter.release()
+
+
+def _acquire_slot(deadline: float) -> None:
+    remaining = deadline - time.monotonic()
+    if remaining <= 0:
+        raise DeadlineExceeded("deadline passed before the request was sent")
+    if not _limiter.acquire(timeout=remaining):
+        raise DeadlineExceeded("no free request slot before the deadline")
+
+
+def _complete_once(client: Mistral, kwargs: Dict[str, Any], deadline: float, cutoff: float) -> Any:
+    _acquire_slot(deadline)
+    return _complete_with_slot(client, kwargs, deadline, cutoff)
+
+
+def _complete_hedged(client: Mistral, kwargs: Dict[str, Any], deadline: float, cutoff: float) -> Any:
+    """
+    Race the request against a duplicate sent once it is slower than the hedge
+    delay, and return the first success. The hedge only fires when a limiter
+    slot is free, so hedging never queues behind regular traffic. An in-flight
+    request cannot be aborted: the loser finishes in the background and keeps
+    its slot until then.
+    """
+    _acquire_slot(deadline)
+    primary = _pool.submit(_complete_with_slot, client, kwargs, deadline, cutoff)
+    futures, hedge = [primary], None
+    try:
+        done, _ = wait([primary], timeout=max(0.0, min(_hedge_delay(), deadline - time.monotonic())))
+        if not done:
+            if time.monotonic() < deadline and _limiter.acquire(blocking=False):
+                _bump("hedges")
+                # the duplicate starts late, so it may use the whole deadline rather than `cutoff`
+                hedge = _pool.submit(_complete_with_slot, client, kwargs, deadline, deadline)
+                futures.append(hedge)
+            else:
+                _bump("hedges_skipped")
+
+        pending, error = set(futures), None
+        while pending:
+            done, pending = wait(pending, timeout=max(0.0, deadline - time.monotonic()), return_when=FIRST_COMPLETED)
+            if not done:
+                raise DeadlineExceeded("no answer before the deadline")
+            for f in done:
+                if f.exception() is None:
+                    if f is hedge:
+                        _bump("hedge_wins")
+                    return f.result()
+                error = f.exception()
+        raise error
+    finally:
+        for f in futures:
+            f.cancel()  # no-op once running; nothing submitted here is ever left queued
 
 def _format_context(chunks: Iterable[str], max_chunks: int = 12) -> str:
     """Join retrieved chunks with clear delimiters and mild deduping."""
@@ -36,6 +182,12 @@ def answer_with_tone(
     stream: bool = False,
     system_preamble: Optional[str] = None,
     cite_sources: bool = True,
+    server_url: Optional[str] = None,
+    usage: Optional[Dict[str, int]] = None,
+    deadline_s: float = DEFAULT_DEADLINE_S,
+    max_attempts: int = 4,
+    hedge: bool = False,
+    fallback_model: Optional[str] = FALLBACK_MODEL,
 ) -> Union[str, Generator[str, None, None]]:
     """
     Use Mistral chat API to answer `query` using `chunks` as retrieval context,
@@ -63,6 +215,24 @@ def answer_with_tone(
         Extra system guidance merged with the default system message.
     cite_sources : bool
         If True, the assistant will include lightweight inline citations like [S1], [S2] tied to chunk indices.
+    server_url : Optional[str]
+        API base URL. If None, reads MISTRAL_SERVER_URL, else the Mistral default.
+        Point it at fake_llm.py to run without the real API.
+    usage : Optional[dict]
+        If given (non-streaming only), filled with prompt_tokens / completion_tokens / total_tokens.
+    deadline_s : float
+        Wall-clock budget for the whole call, including retries and waiting for a
+        free slot in the client-side limiter (MISTRAL_MAX_CONCURRENCY). Raises
+        DeadlineExceeded when it runs out.
+    max_attempts : int
+        Attempts for retryable failures (429, 5xx, timeouts, connection errors),
+        spaced by jittered exponential backoff.
+    hedge : bool
+        If True, send a duplicate request once the first is slower than the recent
+        p95 latency and take whichever answers first (non-streaming only).
+    fallback_model : Optional[str]
+        Attempts on `model` time out once 70% of the deadline is used; retries after
+        that go to this model. None disables (attempts may then use the whole deadline).
 
     Returns
     -------
@@ -108,29 +278,71 @@ Note: No need to mention the context chunks in the answer., act as a expert in t
         {"role": "user", "content": user_prompt},
     ]
 
-    client = Mistral(api_key=api_key)
+    server_url = server_url or os.environ.get("MISTRAL_SERVER_URL") or None
+    client = Mistral(api_key=api_key, server_url=server_url)
+    deadline = time.monotonic() + deadline_s
     if not stream:
-        with client:
-            resp = client.chat.complete(
-                model=model,
-                messages=messages,
-                temperature=temperature,
-                max_tokens=max_tokens,
-                stream=False,
+        # the primary model gets FALLBACK_AT of the budget per attempt, so a slow
+        # answer times out with time left to retry on the fallback model
+        fallback_at = deadline - (1 - FALLBACK_AT) * deadline_s
+
+        def _attempt() -> Any:
+            use_model, cutoff = model, (fallback_at if fallback_model else deadline)
+            if fallback_model and time.monotonic() >= fallback_at:
+                use_model, cutoff = fallback_model, deadline
+                _bump("fallbacks")
+            kwargs = dict(model=use_model, messages=messages, temperature=temperature,
+                          max_tokens=max_tokens, stream=False)
+            if hedge:
+                return _complete_hedged(client, kwargs, deadline, cutoff)
+            return _complete_once(client, kwargs, deadline, cutoff)
+
+        backoff = wait_random_exponential(multiplier=0.5, max=8.0)
+        retrying = Retrying(
+            stop=stop_after_attempt(max_attempts) | (lambda rs: time.monotonic() >= deadline),
+            wait=lambda rs: min(backoff(rs), max(0.0, deadline - time.monotonic())),
+            retry=retry_if_exception(_is_retryable),
+            before_sleep=lambda rs: _bump("retries"),
+            reraise=True,
+        )
+        _bump("calls")
+        try:
+            with client:
+                resp = retrying(_attempt)
+        except DeadlineExceeded:
+            _bump("deadline_exceeded")
+            raise
+        except Exception as e:
+            if _is_retryable(e) and time.monotonic() >= deadline:
+                _bump("deadline_exceeded")
+                raise DeadlineExceeded(f"no answer within {deadline_s:.1f}s (last error: {e})") from e
+            _bump("failures")
+            raise
+        if usage is not None and resp.usage is not None:
+            usage.update(
+                prompt_tokens=resp.usage.prompt_tokens,
+                completion_tokens=resp.usage.completion_tokens,
+                total_tokens=resp.usage.total_tokens,
             )
         return resp.choices[0].message.content
 
     # Streaming branch: yield text deltas as they arrive
     def _stream() -> Generator[str, None, None]:
-        with client:
-            for event in client.chat.stream(
-                model=model,
-                messages=messages,
-                temperature=temperature,
-                max_tokens=max_tokens,
-            ):
-                if event.data and hasattr(event.data, "delta") and event.data.delta:
-                    yield event.data.delta
+        if not _limiter.acquire(timeout=deadline_s):
+            raise DeadlineExceeded("no free request slot before the deadline")
+        try:
+            with client:
+                for event in client.chat.stream(
+                    model=model,
+                    messages=messages,
+                    temperature=temperature,
+                    max_tokens=max_tokens,
+                    timeout_ms=int(deadline_s * 1e3),
+                ):
+                    if event.data and hasattr(event.data, "delta") and event.data.delta:
+                        yield event.data.delta
+        finally:
+            _limiter.release()
 
     return _stream()
 
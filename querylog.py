@@ -0,0 +1,88 @@
+import os
+import json
+import time
+import uuid
+import threading
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional
+
+DEFAULT_LOG_PATH = "query_log.jsonl"
+
+
+class StageTimer:
+    """Collects per-stage wall-clock timings in milliseconds."""
+
+    def __init__(self):
+        self.ms: Dict[str, float] = {}
+        self._t0 = time.perf_counter()
+
+    @contextmanager
+    def stage(self, name: str):
+        t = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.ms[name] = round((time.perf_counter() - t) * 1e3, 3)
+
+    def total(self) -> float:
+        return round((time.perf_counter() - self._t0) * 1e3, 3)
+
+
+class QueryLogger:
+    """
+    Append one JSON record per chat turn to a JSONL file.
+    Safe to share between Streamlit sessions (one lock, one write per record).
+    """
+
+    def __init__(self, path: str = DEFAULT_LOG_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def from_env() -> Optional["QueryLogger"]:
+        """Logger for $QUERY_LOG_PATH, or None when logging is off (the default)."""
+        path = os.environ.get("QUERY_LOG_PATH", "").strip()
+        return QueryLogger(path) if path else None
+
+    def log_turn(
+        self,
+        *,
+        raw_query: str,
+        cleaned_query: Optional[str],
+        top_k: int,
+        hits: List[Dict[str, Any]],
+        timer: StageTimer,
+        usage: Optional[Dict[str, int]] = None,
+        session: Optional[str] = None,
+        **extra: Any,
+    ) -> Dict[str, Any]:
+        record = {
+            "ts": time.time(),
+            "turn_id": str(uuid.uuid4()),
+            "session": session,
+            "raw_query": raw_query,
+            "cleaned_query": cleaned_query,
+            "top_k": top_k,
+            "retrieved": [{"id": h.get("id"), "score": h.get("score")} for h in hits],
+            "timings_ms": {**timer.ms, "total": timer.total()},
+            "tokens": usage or {},
+            **extra,
+        }
+        line = json.dumps(record, ensure_ascii=False)
+        with self._lock:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(line + "\n")
+        return record
+
+
+def read_log(path: str) -> Iterator[Dict[str, Any]]:
+    """Yield records from a query log, skipping blank or truncated lines."""
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError:
+                continue
@@ -0,0 +1,266 @@
+import os
+os.environ["TOKENIZERS_PARALLELISM"] = "false"
+import re
+import glob
+import pickle
+import time
+import argparse
+import threading
+import numpy as np
+from typing import Callable, Dict, Any, List, Optional
+from sentence_transformers import SentenceTransformer
+
+from embed import read_index, write_index, stage_index, index_lock, make_manifest
+
+
+def version_path(cache_path: str, version: int) -> str:
+    """vector_cache.pkl -> vector_cache.v3.pkl"""
+    root, ext = os.path.splitext(cache_path)
+    return f"{root}.v{version}{ext}"
+
+
+def list_versions(cache_path: str) -> List[int]:
+    """Versions kept next to `cache_path` for rollback, oldest first."""
+    root, ext = os.path.splitext(cache_path)
+    found = []
+    for p in glob.glob(f"{glob.escape(root)}.v*{ext}"):
+        m = re.fullmatch(re.escape(root) + r"\.v(\d+)" + re.escape(ext), p)
+        if m:
+            found.append(int(m.group(1)))
+    return sorted(found)
+
+
+def _live_rows(data: Dict[str, Any]) -> Dict[str, List]:
+    """ids/texts/sources of an index without its tombstoned rows (re-embedding compacts for free)."""
+    dead = set(data.get("deleted", ()))
+    sources = data.get("sources") or [None] * len(data["ids"])
+    rows = [i for i, cid in enumerate(data["ids"]) if cid not in dead]
+    return {
+        "ids": [data["ids"][i] for i in rows],
+        "texts": [data["texts"][i] for i in rows],
+        "sources": [sources[i] for i in rows],
+    }
+
+
+def _print_progress(p: Dict[str, Any]) -> None:
+    eta = f"{p['eta_s']:.0f}s" if p["eta_s"] is not None else "?"
+    print(f"[reindex] {p['done']}/{p['total']} chunks  {p['rate']:.1f} chunks/s  eta {eta}", flush=True)
+
+
+class ReembedJob:
+    """
+    Rebuild the index at `cache_path` with a different encoder, from the stored texts.
+
+    The live file is only read while the job runs, so the current version keeps
+    serving queries. Every `checkpoint_every` batches the newly embedded ones are
+    appended to `<cache_path>.reembed.partial`; re-running the same job resumes
+    from there.
+    Chunks added to the live index while the job runs are picked up before the
+    cut-over, which is a single os.replace. The previous version is kept as
+    `vector_cache.v<N>.pkl` for `rollback()`.
+    """
+
+    def __init__(
+        self,
+        cache_path: str = "vector_cache.pkl",
+        model_name: str = "sentence-transformers/all-MiniLM-L6-v2",
+        *,
+        batch_size: int = 64,
+        checkpoint_every: int = 10,
+        progress: Optional[Callable[[Dict[str, Any]], None]] = _print_progress,
+        on_cutover: Optional[Callable[[], None]] = None,
+    ):
+        self.cache_path = cache_path
+        self.model_name = model_name
+        self.batch_size = batch_size
+        self.checkpoint_every = checkpoint_every
+        self.progress = progress
+        self.on_cutover = on_cutover
+        self.partial_path = cache_path + ".reembed.partial"
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self.error: Optional[BaseException] = None
+
+    # ---------- background control ----------
+    def start(self) -> threading.Thread:
+        """Run the job on a daemon thread (e.g. inside the Streamlit process)."""
+        def _target():
+            try:
+                self.run()
+            except BaseException as e:
+                self.error = e
+        self._thread = threading.Thread(target=_target, name="reembed", daemon=True)
+        self._thread.start()
+        return self._thread
+
+    def stop(self) -> None:
+        """Ask a running job to checkpoint and exit; run it again to resume."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    # ---------- job ----------
+    # The partial file is append-only: a header pickle with the manifest, then one
+    # pickle of {"ids", "embeddings"} per checkpoint holding only the batches
+    # embedded since the previous one, so checkpointing costs O(new rows).
+    def _load_partial(self, dim: int) -> Dict[str, Any]:
+        """Embeddings saved by an earlier run: {"ids": [...], "blocks": [arrays]}."""
+        new: Dict[str, Any] = {"ids": [], "blocks": []}
+        if not os.path.exists(self.partial_path):
+            return new
+        with open(self.partial_path, "rb+") as f:
+            try:
+                m = pickle.load(f)["manifest"]
+            except Exception:
+                m = None
+            if not (m and m["model_name"] == self.model_name and m["dim"] == dim):
+                f.close()
+                os.remove(self.partial_path)  # another model's progress (or garbage)
+                return new
+            good = f.tell()
+            while True:
+                try:
+                    rec = pickle.load(f)
+                except (EOFError, pickle.UnpicklingError, ValueError):
+                    break
+                new["ids"].extend(rec["ids"])
+                new["blocks"].append(rec["embeddings"])
+                good = f.tell()
+            f.truncate(good)  # drop a record cut short by a crash
+        return new
+
+    def _checkpoint(self, manifest: Dict[str, Any], ids: List[str], blocks: List[np.ndarray]) -> None:
+        """Append the batches embedded since the last checkpoint to the partial file."""
+        if not ids:
+            return
+        fresh = not os.path.exists(self.partial_path)
+        with open(self.partial_path, "ab") as f:
+            if fresh:
+                pickle.dump({"manifest": manifest}, f, protocol=pickle.HIGHEST_PROTOCOL)
+            pickle.dump({"ids": ids, "embeddings": np.concatenate(blocks)}, f, protocol=pickle.HIGHEST_PROTOCOL)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _embed_pending(self, model: SentenceTransformer, live: Dict[str, Any], new: Dict[str, Any], manifest: Dict[str, Any]) -> bool:
+        """Embed every live chunk missing from `new`. Returns False if stopped early."""
+        done = set(new["ids"])
+        pending = [(cid, txt) for cid, txt in zip(live["ids"], live["texts"]) if cid not in done]
+        total = len(done) + len(pending)
+        t0 = time.perf_counter()
+        n_done = 0
+        saved = (len(new["ids"]), len(new["blocks"]))  # what the partial file already holds
+
+        def checkpoint():
+            nonlocal saved
+            self._checkpoint(manifest, new["ids"][saved[0]:], new["blocks"][saved[1]:])
+            saved = (len(new["ids"]), len(new["blocks"]))
+
+        for b, start in enumerate(range(0, len(pending), self.batch_size), start=1):
+            if self._stop.is_set():
+                checkpoint()
+                return False
+            batch = pending[start:start + self.batch_size]
+            vecs = model.encode([t for _, t in batch], normalize_embeddings=True, convert_to_numpy=True).astype(np.float32)
+            new["ids"].extend(cid for cid, _ in batch)
+            new["blocks"].append(vecs)
+            n_done += len(batch)
+
+            if b % self.checkpoint_every == 0:
+                checkpoint()
+            if self.progress:
+                rate = n_done / max(time.perf_counter() - t0, 1e-9)
+                left = len(pending) - n_done
+                self.progress({
+                    "done": len(done) + n_done,
+                    "total": total,
+                    "rate": rate,
+                    "eta_s": left / rate if rate > 0 else None,
+                })
+        checkpoint()
+        return True
+
+    def run(self) -> Optional[str]:
+        """Re-embed, cut over and return the live path; None if stopped before finishing."""
+        model = SentenceTransformer(self.model_name)
+        dim = model.get_sentence_embedding_dimension()
+        new = self._load_partial(dim)
+
+        while True:
+            live_mtime = os.stat(self.cache_path).st_mtime_ns
+            live = read_index(self.cache_path)
+            view = _live_rows(live)
+            old_version = (live["manifest"] or {}).get("version", 0)
+            new_version = max(list_versions(self.cache_path) + [old_version]) + 1
+            manifest = make_manifest(self.model_name, dim, version=new_version)
+            if not self._embed_pending(model, view, new, manifest):
+                return None
+
+            # keep the live order and drop anything deleted from the live index
+            if len(new["blocks"]) != 1:  # one concatenate per pass, not one vstack per batch
+                new["blocks"] = [np.concatenate(new["blocks"]) if new["blocks"] else np.empty((0, dim), dtype=np.float32)]
+            emb = new["blocks"][0]
+            pos = {cid: i for i, cid in enumerate(new["ids"])}
+            order = [pos[cid] for cid in view["ids"]]
+            payload = {
+                "manifest": manifest,
+                **view,
+                "embeddings": emb[order] if order else emb[:0],
+                "deleted": [],
+            }
+
+            # do all the slow writes first (rollback copy, staged payload); the
+            # append check and the replace then run under the writers' lock, so no
+            # EmbeddingStore save can land between them
+            write_index(version_path(self.cache_path, old_version), live)
+            staged = stage_index(self.cache_path, payload)
+            with index_lock(self.cache_path):
+                if os.stat(self.cache_path).st_mtime_ns != live_mtime:
+                    os.remove(staged)  # someone appended while we were embedding: catch up and retry
+                    continue
+                os.replace(staged, self.cache_path)
+            break
+
+        if os.path.exists(self.partial_path):
+            os.remove(self.partial_path)
+        if self.on_cutover:
+            self.on_cutover()
+        return self.cache_path
+
+
+def rollback(cache_path: str = "vector_cache.pkl") -> int:
+    """
+    Make the newest kept version older than the live one live again.
+    The current live index is itself kept as a version. Returns the version restored.
+    """
+    with index_lock(cache_path):
+        live = read_index(cache_path)
+        current = (live["manifest"] or {}).get("version", 0)
+        older = [v for v in list_versions(cache_path) if v < current]
+        if not older:
+            raise FileNotFoundError(f"no earlier version of {cache_path} to roll back to")
+        target = older[-1]
+        restored = read_index(version_path(cache_path, target))
+        write_index(version_path(cache_path, current), live)
+        write_index(cache_path, restored)
+    return target
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Re-embed the vector cache with a new encoder, or roll back.")
+    ap.add_argument("--cache", default="vector_cache.pkl")
+    ap.add_argument("--model", help="sentence-transformers model to re-embed with")
+    ap.add_argument("--batch-size", type=int, default=64)
+    ap.add_argument("--rollback", action="store_true", help="restore the previous version instead")
+    args = ap.parse_args()
+
+    if args.rollback:
+        print(f"Rolled back {args.cache} to version {rollback(args.cache)}")
+    elif args.model:
+        job = ReembedJob(args.cache, args.model, batch_size=args.batch_size)
+        try:
+            job.run()
+            print(f"Cut over {args.cache} to {args.model}")
+        except KeyboardInterrupt:
+            print(f"Interrupted; progress is in {job.partial_path}, re-run to resume")
+    else:
+        ap.error("pass --model or --rollback")
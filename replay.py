@@ -0,0 +1,180 @@
+import os
+os.environ["TOKENIZERS_PARALLELISM"] = "false"
+import time
+import random
+import argparse
+import threading
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional
+
+import llm
+from embed import EmbeddingStore
+from fake_llm import FakeLLMServer
+from final_pipeline import run_turn
+from querylog import read_log
+
+
+def _schedule(records: List[Dict[str, Any]], rate: float, speed: float, seed: int) -> List[float]:
+    """Arrival offsets in seconds: recorded spacing / speed, Poisson at `rate`, or all at once."""
+    if speed > 0:
+        t0 = records[0].get("ts", 0.0)
+        return [max(0.0, (r.get("ts", t0) - t0) / speed) for r in records]
+    if rate > 0:
+        rng = random.Random(seed)
+        t, out = 0.0, []
+        for _ in records:
+            out.append(t)
+            t += rng.expovariate(rate)
+        return out
+    return [0.0] * len(records)
+
+
+def _repeat(records: List[Dict[str, Any]], times: int) -> List[Dict[str, Any]]:
+    """Loop the log `times` times, shifting each pass's `ts` past the previous one so --speed keeps the spacing."""
+    if times <= 1 or not records:
+        return records
+    ts = [r.get("ts", 0.0) for r in records]
+    span = max(ts) - min(ts)
+    gap = span / (len(records) - 1) if len(records) > 1 and span > 0 else 1.0
+    period = span + gap  # one mean gap between the last turn of a pass and the first of the next
+    return [{**r, "ts": t + k * period} for k in range(times) for r, t in zip(records, ts)]
+
+
+def _pct(values: List[float]) -> Dict[str, float]:
+    if not values:
+        return {}
+    a = np.asarray(values)
+    out = {f"p{p}": round(float(np.percentile(a, p)), 1) for p in (50, 90, 95, 99)}
+    out["max"] = round(float(a.max()), 1)
+    return out
+
+
+def replay(
+    store: EmbeddingStore,
+    records: List[Dict[str, Any]],
+    *,
+    concurrency: int = 4,
+    rate: float = 0.0,
+    speed: float = 0.0,
+    seed: int = 0,
+    **llm_kwargs: Any,
+) -> Dict[str, Any]:
+    """
+    Drive clean -> retrieve -> answer for every logged turn, open-loop: requests
+    are issued on schedule whether or not earlier ones finished, and latency is
+    measured from the scheduled arrival, so queueing shows up in the tail.
+    """
+    offsets = _schedule(records, rate, speed, seed)
+    results: List[Dict[str, Any]] = []
+    errors: List[str] = []
+    lock = threading.Lock()
+
+    def _one(rec: Dict[str, Any], due: float) -> None:
+        # replay with the recorded client settings unless the caller overrides them
+        recorded = {k: rec[k] for k in ("deadline_s", "hedge") if rec.get(k) is not None}
+        try:
+            turn = run_turn(
+                store,
+                rec["raw_query"],
+                top_k=int(rec.get("top_k") or 3),
+                tone=rec.get("tone") or "concise, friendly",
+                temperature=float(rec.get("temperature", 0.6)),
+                max_tokens=int(rec.get("max_tokens") or 1024),
+                **{**recorded, **llm_kwargs},
+            )
+            turn["latency_ms"] = (time.perf_counter() - due) * 1e3
+            with lock:
+                results.append(turn)
+        except Exception as e:
+            with lock:
+                errors.append(f"{type(e).__name__}: {e}")
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for rec, off in zip(records, offsets):
+            due = start + off
+            delay = due - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            pool.submit(_one, rec, due)
+    wall = time.perf_counter() - start
+
+    tokens = sum(r["usage"].get("total_tokens", 0) for r in results)
+    return {
+        "requests": len(records),
+        "ok": len(results),
+        "errors": len(errors),
+        "error_samples": errors[:5],
+        "wall_s": round(wall, 2),
+        "throughput_rps": round(len(results) / wall, 2) if wall else 0.0,
+        "tokens_per_s": round(tokens / wall, 1) if wall else 0.0,
+        "latency_ms": _pct([r["latency_ms"] for r in results]),
+        "stage_ms": {
+            stage: _pct([r["timings_ms"][stage] for r in results])
+            for stage in ("clean", "retrieve", "answer")
+        },
+    }
+
+
+def _print_report(rep: Dict[str, Any]) -> None:
+    print(f"requests={rep['requests']} ok={rep['ok']} errors={rep['errors']} wall={rep['wall_s']}s")
+    print(f"throughput={rep['throughput_rps']} req/s  tokens={rep['tokens_per_s']}/s")
+    print(f"latency ms (from scheduled arrival): {rep['latency_ms']}")
+    for stage, p in rep["stage_ms"].items():
+        print(f"  {stage:<9} {p}")
+    for e in rep["error_samples"]:
+        print("  error:", e)
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Replay a query log through the chat pipeline.")
+    ap.add_argument("log", help="JSONL written with QUERY_LOG_PATH")
+    ap.add_argument("--concurrency", type=int, default=4)
+    ap.add_argument("--rate", type=float, default=0.0, help="Poisson arrivals per second (0 = all at once)")
+    ap.add_argument("--speed", type=float, default=0.0, help="replay recorded spacing at this speed-up instead")
+    ap.add_argument("--limit", type=int, default=None)
+    ap.add_argument("--repeat", type=int, default=1, help="loop the log this many times")
+    ap.add_argument("--server-url", default=None, help="LLM endpoint; default starts a local fake_llm server")
+    ap.add_argument("--llm-base-ms", type=float, default=300.0)
+    ap.add_argument("--llm-ms-per-token", type=float, default=8.0)
+    ap.add_argument("--llm-429-rate", type=float, default=0.0, help="fake server: share of 429 answers")
+    ap.add_argument("--llm-error-rate", type=float, default=0.0, help="fake server: share of 503 answers")
+    ap.add_argument("--llm-slow-rate", type=float, default=0.0, help="fake server: share of slow answers")
+    ap.add_argument("--llm-slow-ms", type=float, default=5000.0)
+    ap.add_argument("--deadline", type=float, default=None, help="per-answer deadline (s); default: as logged")
+    ap.add_argument("--hedge", action=argparse.BooleanOptionalAction, default=None,
+                    help="hedge slow LLM requests; default: as logged")
+    ap.add_argument("--cache", default="vector_cache.pkl")
+    ap.add_argument("--shards", type=int, default=1)
+    args = ap.parse_args()
+
+    records = _repeat([r for r in read_log(args.log) if r.get("raw_query")][:args.limit], args.repeat)
+    if not records:
+        ap.error(f"no turns in {args.log}")
+
+    fake: Optional[FakeLLMServer] = None
+    server_url, api_key = args.server_url, os.environ.get("MISTRAL_API_KEY")
+    if server_url is None:
+        fake = FakeLLMServer(
+            base_ms=args.llm_base_ms, ms_per_token=args.llm_ms_per_token,
+            rate_limit_rate=args.llm_429_rate, error_rate=args.llm_error_rate,
+            slow_rate=args.llm_slow_rate, slow_ms=args.llm_slow_ms, seed=0,
+        ).start()
+        server_url, api_key = fake.url, "replay"
+
+    store = EmbeddingStore(cache_path=args.cache, n_shards=args.shards)
+    try:
+        report = replay(
+            store, records,
+            concurrency=args.concurrency, rate=args.rate, speed=args.speed,
+            server_url=server_url, api_key=api_key,
+            **{k: v for k, v in (("deadline_s", args.deadline), ("hedge", args.hedge)) if v is not None},
+        )
+        _print_report(report)
+        print(f"llm client: {llm.get_metrics()}")
+        if fake is not None:
+            print(f"fake server: {fake.requests} requests, injected {fake.faults}")
+    finally:
+        if fake is not None:
+            fake.stop()
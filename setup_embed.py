@@ -9,8 +9,16 @@ if __name__ == "__main__":
     Limit= int(input("Enter Limit of number of videos: "))
     videos = list_channel_videos(URL, limit=Limit)
     store = EmbeddingStore()
+    before = store.stats()
+    total_chunks = 0
     for v in videos:
         print(v["title"],"-This video is being operated")
         transcript = get_subtitle_whisper(v["url"],model_name="base", language="en")
-        store.add_text(transcript)
+        store.delete_source(v["url"])
+        total_chunks += len(store.add_text(transcript, source=v["url"]))
         print(v["title"],"-This video is added to the database")
+    store.compact()
+    after = store.stats()
+    skipped = after["dupes_skipped"] - before["dupes_skipped"]
+    print(f"Chunks: {total_chunks} transcribed, {total_chunks - skipped} stored, {skipped} duplicates skipped")
+    print(f"Index: {before['live']} -> {after['live']} rows, {after['matrix_bytes'] / 1e6:.1f} MB matrix, {after['file_bytes'] / 1e6:.1f} MB on disk")
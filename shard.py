@@ -0,0 +1,432 @@
+import os
+import time
+import glob
+import zlib
+import itertools
+import shutil
+import atexit
+import tempfile
+import threading
+import argparse
+import multiprocessing as mp
+import numpy as np
+from typing import Dict, List, Optional, Tuple
+
+
+def shard_of(chunk_id: str, n_shards: int) -> int:
+    """Stable shard assignment for a chunk id (same id -> same shard across runs)."""
+    return zlib.crc32(chunk_id.encode("utf-8")) % n_shards
+
+
+def top_k_indices(scores: np.ndarray, top_k: int, order_key: np.ndarray | None = None) -> np.ndarray:
+    """
+    Indices of the `top_k` highest scores, best first.
+    Equal scores are ordered by `order_key` (defaults to the position), so
+    sharded and unsharded search break ties the same way.
+    """
+    n = scores.shape[0]
+    if n == 0 or top_k <= 0:
+        return np.empty(0, dtype=np.int64)
+    if order_key is None:
+        order_key = np.arange(n)
+    if top_k < n:
+        # argpartition alone may cut arbitrarily through a run of equal scores,
+        # so keep everything that ties with the k-th best and sort that.
+        kth = scores[np.argpartition(-scores, top_k - 1)[top_k - 1]]
+        cand = np.flatnonzero(scores >= kth)
+    else:
+        cand = np.arange(n)
+    order = np.lexsort((order_key[cand], -scores[cand]))
+    return cand[order[:top_k]]
+
+
+# ---------- worker process ----------
+QUERY_BATCH = 64  # queries a worker scores together when several are waiting
+
+
+def _search_segments(segments: list, queries: list) -> list:
+    """Top-k over (emb, gidx, alive) segments for a batch of (q, top_k); dead rows never come back."""
+    q = np.stack([x[0] for x in queries])
+    k_max = max(x[1] for x in queries)
+    parts = [[] for _ in queries]
+    for emb, gidx, alive in segments:
+        if gidx.shape[0] == 0:
+            continue
+        scores = emb @ q.T  # one matrix product for the whole batch
+        scores[~alive] = -np.inf
+        for c in range(len(queries)):
+            top = top_k_indices(scores[:, c], k_max, order_key=gidx)
+            top = top[np.isfinite(scores[top, c])]
+            parts[c].append((gidx[top], scores[top, c]))
+    out = []
+    for (_, k), segs in zip(queries, parts):
+        if not segs:
+            out.append((np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)))
+            continue
+        gidx = np.concatenate([g for g, _ in segs])
+        sc = np.concatenate([x for _, x in segs])
+        top = top_k_indices(sc, k, order_key=gidx)
+        out.append((gidx[top], sc[top]))
+    return out
+
+
+def _worker(conn) -> None:
+    """
+    Long-lived shard worker. Holds a memory-mapped base segment plus an
+    append-only tail, each with an alive mask; every message carries a request
+    id that is echoed back with the reply, and queries that arrive together
+    are scored as one batch.
+    """
+    base = tail = None  # [emb, gidx, alive]
+    tail_path, dim = None, 0
+    backlog: list = []
+    while True:
+        msg = backlog.pop(0) if backlog else conn.recv()
+        op, rid = msg[0], msg[1] if len(msg) > 1 else None
+        if op == "load":
+            _, _, prefix, tail_path, dim = msg
+            gidx = np.load(prefix + ".idx.npy")
+            base = [np.load(prefix + ".emb.npy", mmap_mode="r"), gidx, np.ones(gidx.shape[0], dtype=bool)]
+            tail = [np.empty((0, dim), dtype=np.float32), np.empty(0, dtype=np.int64), np.empty(0, dtype=bool)]
+            conn.send(("ok", rid, int(gidx.shape[0])))
+        elif op == "append":
+            _, _, n_tail, new_gidx = msg
+            if n_tail:  # the parent appended rows to the tail file; map the grown file
+                tail[0] = np.memmap(tail_path, dtype=np.float32, mode="r", shape=(n_tail, dim))
+            tail[1] = np.concatenate([tail[1], new_gidx])
+            tail[2] = np.concatenate([tail[2], np.ones(len(new_gidx), dtype=bool)])
+            conn.send(("ok", rid, n_tail))
+        elif op == "kill":
+            rows = msg[2]
+            for seg in (base, tail):
+                if seg is None or seg[1].shape[0] == 0:
+                    continue
+                # row positions are ascending within each segment
+                pos = np.minimum(np.searchsorted(seg[1], rows), seg[1].shape[0] - 1)
+                seg[2][pos[seg[1][pos] == rows]] = False
+            conn.send(("ok", rid, None))
+        elif op == "query":
+            batch = [msg]
+            while len(batch) < QUERY_BATCH and conn.poll():
+                nxt = conn.recv()
+                if nxt[0] != "query":
+                    backlog.append(nxt)  # keep order: handle it right after this batch
+                    break
+                batch.append(nxt)
+            if base is None:
+                results = [(np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32))] * len(batch)
+            else:
+                results = _search_segments([base, tail], [(m[2], m[3]) for m in batch])
+            for m, (g, sc) in zip(batch, results):
+                conn.send(("result", m[1], g, sc))
+        elif op == "close":
+            conn.close()
+            return
+
+
+class _Call:
+    """Replies to one fan-out, filled in by the reader threads."""
+
+    def __init__(self, conns: list):
+        self.conns = list(conns)
+        self.replies = [None] * len(conns)
+        self.left = len(conns)
+        self.error: Optional[str] = None
+        self.done = threading.Event()
+
+    def wait(self) -> list:
+        self.done.wait()
+        if self.error:
+            raise EOFError(self.error)
+        return self.replies
+
+
+class ShardedIndex:
+    """
+    Exact inner-product search split across `n_shards` worker processes.
+
+    Rows are assigned to shards by a hash of their chunk id. build() writes a
+    base generation of .npy files under a private directory inside
+    `shard_root`; append() adds rows to a per-shard tail file and kill()
+    tombstones rows with a mask, so writes cost O(new rows) instead of a full
+    rewrite. Workers memory-map the files, so the page cache is shared
+    instead of copied. Every fan-out is tagged with a request id and replies
+    are collected by one reader thread per worker, so concurrent searches
+    are in flight together (and batched by the workers) instead of taking
+    turns. A worker that died is respawned and brought back to the current
+    state on the next call. Safe to share between threads.
+    """
+
+    def __init__(self, n_shards: int, shard_root: str):
+        if n_shards < 1:
+            raise ValueError("n_shards must be >= 1")
+        self.n_shards = n_shards
+        # one directory per instance, so two stores on the same cache never
+        # overwrite or delete files the other's workers have mapped
+        os.makedirs(shard_root, exist_ok=True)
+        self.shard_dir = tempfile.mkdtemp(prefix=f"idx-{os.getpid()}-", dir=shard_root)
+        self._gen = 0
+        self._dim = 0
+        self.base_rows = 0
+        # what every worker should hold beyond the base, to bring a respawned one back
+        self._tail_n = [0] * n_shards
+        self._tail_idx: List[List[np.ndarray]] = [[] for _ in range(n_shards)]
+        self._killed: List[np.ndarray] = []
+        # _lock orders writes to the pipes and state changes; replies are not waited for under it
+        self._lock = threading.Lock()
+        self._calls: Dict[int, _Call] = {}
+        self._calls_lock = threading.Lock()
+        self._rids = itertools.count(1)
+        # spawn keeps torch/tokenizer state of the parent out of the workers
+        self._ctx = mp.get_context("spawn")
+        self._conns = [None] * n_shards
+        self._procs = [None] * n_shards
+        for s in range(n_shards):
+            self._spawn(s)
+        atexit.register(self.close)
+
+    @property
+    def tail_rows(self) -> int:
+        return sum(self._tail_n)
+
+    @property
+    def generation(self) -> int:
+        """Bumped by every build(); tells callers which rows a result refers to."""
+        return self._gen
+
+    def _prefix(self, shard: int, gen: int) -> str:
+        return os.path.join(self.shard_dir, f"shard_{shard:03d}.g{gen}")
+
+    def _tail_path(self, shard: int, gen: int) -> str:
+        return self._prefix(shard, gen) + ".tail.f32"
+
+    # ---------- workers and IPC ----------
+    def _spawn(self, shard: int) -> None:
+        """(Re)start one worker and replay the current generation, tail and tombstones into it."""
+        # the old pipe, if any, is closed by its reader thread once it sees EOF
+        parent, child = self._ctx.Pipe()
+        p = self._ctx.Process(target=_worker, args=(child,), daemon=True)
+        p.start()
+        child.close()
+        self._conns[shard], self._procs[shard] = parent, p
+        threading.Thread(target=self._read, args=(shard, parent), name=f"shard-{shard}-reader", daemon=True).start()
+        if self._gen:
+            # replies to these carry ids nobody waits for and are dropped
+            parent.send(("load", 0, self._prefix(shard, self._gen), self._tail_path(shard, self._gen), self._dim))
+            if self._tail_n[shard]:
+                parent.send(("append", 0, self._tail_n[shard], np.concatenate(self._tail_idx[shard])))
+            if self._killed:
+                parent.send(("kill", 0, np.unique(np.concatenate(self._killed))))
+
+    def _respawn_dead(self) -> None:
+        for s, p in enumerate(self._procs):
+            if not p.is_alive():
+                self._spawn(s)
+
+    def _read(self, shard: int, conn) -> None:
+        """Reader thread: route each reply to the call waiting for its request id."""
+        while True:
+            try:
+                msg = conn.recv()
+            except (EOFError, OSError):
+                conn.close()
+                break
+            with self._calls_lock:
+                call = self._calls.get(msg[1])
+                if call is None or call.replies[shard] is not None:
+                    continue
+                call.replies[shard] = msg
+                call.left -= 1
+                if call.left == 0:
+                    del self._calls[msg[1]]
+                    call.done.set()
+        # worker gone: fail whatever was still waiting on this pipe
+        with self._calls_lock:
+            for rid, call in list(self._calls.items()):
+                if call.conns[shard] is conn and call.replies[shard] is None:
+                    call.error = f"shard {shard} worker exited"
+                    del self._calls[rid]
+                    call.done.set()
+
+    def _send(self, make_msg) -> _Call:
+        """Send make_msg(shard, rid) to every worker; the caller holds _lock. Wait on the result outside it."""
+        self._respawn_dead()
+        rid = next(self._rids)
+        call = _Call(self._conns)
+        with self._calls_lock:
+            self._calls[rid] = call
+        try:
+            for s in range(self.n_shards):
+                try:
+                    self._conns[s].send(make_msg(s, rid))
+                except OSError:  # died since the liveness check
+                    self._procs[s].kill()
+                    self._procs[s].join()
+                    self._spawn(s)
+                    call.conns[s] = self._conns[s]
+                    self._conns[s].send(make_msg(s, rid))
+        except OSError as e:
+            with self._calls_lock:
+                self._calls.pop(rid, None)
+            call.error = str(e)
+            call.done.set()
+        return call
+
+    # ---------- writes ----------
+    def build(self, ids: List[str], embeddings: np.ndarray, rows: np.ndarray | None = None) -> None:
+        """
+        (Re)write a base generation for `embeddings` and point every worker at it.
+        `rows` optionally restricts the index to a subset of row positions;
+        results always refer to positions in the full `embeddings` matrix.
+        """
+        if rows is None:
+            rows = np.arange(len(ids))
+        assign = np.fromiter((shard_of(ids[i], self.n_shards) for i in rows), dtype=np.int64, count=len(rows))
+
+        with self._lock:
+            gen = self._gen + 1
+            for s in range(self.n_shards):
+                gidx = rows[assign == s].astype(np.int64)
+                prefix = self._prefix(s, gen)
+                np.save(prefix + ".emb.npy", np.ascontiguousarray(embeddings[gidx], dtype=np.float32))
+                np.save(prefix + ".idx.npy", gidx)
+                open(self._tail_path(s, gen), "wb").close()
+            self._gen, self._dim, self.base_rows = gen, embeddings.shape[1], len(rows)
+            self._tail_n = [0] * self.n_shards
+            self._tail_idx = [[] for _ in range(self.n_shards)]
+            self._killed = []
+            call = self._send(lambda s, rid: ("load", rid, self._prefix(s, gen), self._tail_path(s, gen), self._dim))
+        try:
+            call.wait()
+        except EOFError:
+            pass  # a respawned worker loads the new generation itself
+
+        # workers have the new generation mapped (queries sent earlier were
+        # answered first, in order); old files can go
+        keep = tuple(self._prefix(s, gen) + "." for s in range(self.n_shards))
+        for path in glob.glob(os.path.join(self.shard_dir, "shard_*.g*")):
+            if not path.startswith(keep):
+                os.remove(path)
+
+    def append(self, ids: List[str], embeddings: np.ndarray, rows: np.ndarray) -> None:
+        """Add `rows` (ascending positions past everything indexed) to the shards' tail files."""
+        rows = np.asarray(rows, dtype=np.int64)
+        if not self._gen or rows.size == 0:
+            return
+        assign = np.fromiter((shard_of(ids[i], self.n_shards) for i in rows), dtype=np.int64, count=len(rows))
+        with self._lock:
+            new = {}
+            for s in range(self.n_shards):
+                sel = rows[assign == s]
+                if sel.size == 0:
+                    continue
+                with open(self._tail_path(s, self._gen), "ab") as f:
+                    f.write(np.ascontiguousarray(embeddings[sel], dtype=np.float32).tobytes())
+                self._tail_n[s] += len(sel)
+                self._tail_idx[s].append(sel)
+                new[s] = sel
+            empty = np.empty(0, dtype=np.int64)
+            self._send(lambda s, rid: ("append", rid, self._tail_n[s], new.get(s, empty)))
+
+    def kill(self, rows: np.ndarray) -> None:
+        """Tombstone row positions; workers mask them out of every later search."""
+        rows = np.unique(np.asarray(rows, dtype=np.int64))
+        if not self._gen or rows.size == 0:
+            return
+        with self._lock:
+            self._killed.append(rows)
+            self._send(lambda s, rid: ("kill", rid, rows))
+
+    # ---------- search ----------
+    def search(self, q: np.ndarray, top_k: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Fan the query out to every shard and merge the per-shard top-k."""
+        gidx, scores, _ = self.search_gen(q, top_k)
+        return gidx, scores
+
+    def search_gen(self, q: np.ndarray, top_k: int) -> Tuple[np.ndarray, np.ndarray, int]:
+        """Like search(), plus the generation the result was computed on."""
+        q = np.ascontiguousarray(q, dtype=np.float32)
+        for attempt in range(2):
+            with self._lock:
+                gen = self._gen
+                call = self._send(lambda s, rid: ("query", rid, q, top_k))
+            try:
+                parts = call.wait()
+                break
+            except EOFError:
+                if attempt:
+                    raise  # retried once on a respawned worker
+        gidx = np.concatenate([p[2] for p in parts])
+        scores = np.concatenate([p[3] for p in parts])
+        top = top_k_indices(scores, top_k, order_key=gidx)
+        return gidx[top], scores[top], gen
+
+    def close(self) -> None:
+        with self._lock:
+            for conn in self._conns:
+                try:
+                    conn.send(("close",))  # the reader thread closes the pipe on EOF
+                except OSError:
+                    pass
+            for p in self._procs:
+                p.join(timeout=5)
+            self._conns, self._procs = [], []
+            shutil.rmtree(self.shard_dir, ignore_errors=True)
+
+
+# ----------- benchmark -----------
+def _timed(fn, qs: np.ndarray, clients: int) -> Tuple[float, list]:
+    """Run fn over every query from `clients` threads; returns (wall seconds, results in order)."""
+    out: list = [None] * len(qs)
+
+    def run(c: int) -> None:
+        for i in range(c, len(qs), clients):
+            out[i] = fn(qs[i])
+
+    threads = [threading.Thread(target=run, args=(c,)) for c in range(clients)]
+    t0 = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return time.perf_counter() - t0, out
+
+
+def _bench(sizes: List[int], workers: List[int], dim: int, n_queries: int, top_k: int, shard_dir: str, clients: int) -> None:
+    rng = np.random.default_rng(0)
+    print(f"cpus={os.cpu_count()} dim={dim} queries={n_queries} top_k={top_k} clients={clients}")
+    print(f"{'rows':>10} {'workers':>8} {'ms/query':>10} {'qps':>8} {'speedup':>8} {'identical':>10}")
+    for n in sizes:
+        emb = rng.standard_normal((n, dim), dtype=np.float32)
+        emb /= np.linalg.norm(emb, axis=1, keepdims=True)
+        ids = [f"{i:012d}" for i in range(n)]
+        qs = rng.standard_normal((n_queries, dim), dtype=np.float32)
+        qs /= np.linalg.norm(qs, axis=1, keepdims=True)
+
+        wall, exact = _timed(lambda q: top_k_indices(emb @ q, top_k), qs, clients)
+        base = wall / n_queries
+        print(f"{n:>10} {'exact':>8} {base * 1e3:>10.2f} {1 / base:>8.1f} {1.0:>8.2f} {'-':>10}")
+
+        for w in workers:
+            index = ShardedIndex(w, shard_dir)
+            index.build(ids, emb)
+            index.search(qs[0], top_k)  # warm page cache
+            wall, got = _timed(lambda q: index.search(q, top_k)[0], qs, clients)
+            dt = wall / n_queries
+            same = all(np.array_equal(a, b) for a, b in zip(exact, got))
+            print(f"{n:>10} {w:>8} {dt * 1e3:>10.2f} {1 / dt:>8.1f} {base / dt:>8.2f} {str(same):>10}")
+            index.close()
+        del emb
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Benchmark sharded vs exact search on synthetic vectors.")
+    ap.add_argument("--sizes", type=int, nargs="+", default=[100_000, 500_000, 1_000_000])
+    ap.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8])
+    ap.add_argument("--dim", type=int, default=384)
+    ap.add_argument("--queries", type=int, default=50)
+    ap.add_argument("--top-k", type=int, default=5)
+    ap.add_argument("--clients", type=int, default=1, help="threads issuing queries concurrently")
+    ap.add_argument("--shard-dir", default="bench.shards")
+    args = ap.parse_args()
+    _bench(args.sizes, args.workers, args.dim, args.queries, args.top_k, args.shard_dir, args.clients)